@@ -1,108 +1,247 @@
 import argparse
+import asyncio
+import functools
+import http.client
 import json
 import random
+import re
 import subprocess
 import sys
+import threading
 import time
+from collections import deque
 from pathlib import Path
+from urllib.parse import urlsplit
 
-base_price = 0
-quantity_floor = 0
-quantity_ceiling = 0
-
-CMD = "printf '{password}\n' | {binary}"
-PLACE_ORDER_TMPL = (
-    " tx dex place-orders {contract} "
-    "\'{order_type}?{price}?{quantity}?{price_denom}?{asset_denom}?LIMIT?{order_data}\'"
-    " --amount=100000000uusdc -y --from={key} --chain-id={chain_id} --fees=1000000usei --gas=50000000 --broadcast-mode=block"
-)
-EXCHANGE_RATES_TMPL = (
-    " query oracle exchange-rates | grep -A 2 \"{denom}\" | "
-    "sed -n 's/.*exchange_rate: \"//p' | sed -n 's/\"//p'"
- )
+# funds sent along with each order in a batch
+ORDER_DEPOSIT_UUSDC = 100000000
+PLACE_ORDERS_FLAGS = [
+    "-y", "--fees=1000000usei", "--gas=50000000",
+    "--broadcast-mode=sync", "--output=json",
+]
+# cosmos-sdk ErrWrongSequence, raw_log reads "account sequence mismatch, expected N, got M"
+SEQUENCE_MISMATCH_CODESPACE = "sdk"
+SEQUENCE_MISMATCH_CODE = 32
+EXPECTED_SEQUENCE_RE = re.compile(r"expected (\d+)")
+EXCHANGE_RATES_PATH = "/sei-protocol/sei-chain/oracle/denoms/exchange_rates"
+ACCOUNT_PATH = "/cosmos/auth/v1beta1/accounts/{address}"
+TX_PATH = "/cosmos/tx/v1beta1/txs/{txhash}"
+
+class RestClient:
+    """Keep-alive JSON client for the node's REST (LCD) endpoint."""
+
+    def __init__(self, url) -> None:
+        parts = urlsplit(url)
+        if parts.scheme == "https":
+            self._conn = http.client.HTTPSConnection(parts.netloc, timeout=10)
+        else:
+            self._conn = http.client.HTTPConnection(parts.netloc, timeout=10)
+        # the connection is shared by the price, poller and resync worker
+        # threads; this also keeps REST traffic to one request at a time
+        self._lock = threading.Lock()
+
+    def get_json(self, path, allow_missing=False):
+        with self._lock:
+            try:
+                self._conn.request("GET", path)
+                response = self._conn.getresponse()
+            except (http.client.HTTPException, OSError):
+                # the node may have dropped the idle connection, reconnect once
+                self._conn.close()
+                self._conn.request("GET", path)
+                response = self._conn.getresponse()
+            body = response.read()
+        if allow_missing and response.status == 404:
+            return None
+        if response.status != 200:
+            raise RuntimeError(f"GET {path} returned {response.status}: {body!r}")
+        return json.loads(body)
 
 class OrderData:
     def __init__(self, position_effect="Open", leverage="1") -> None:
         self.position_effect = position_effect
         self.leverage = leverage
 
+@functools.lru_cache(maxsize=None)
+def order_data_json(position_effect, leverage):
+    """Serialized OrderData, computed once per (position_effect, leverage)."""
+    return json.dumps(OrderData(position_effect, leverage).__dict__)
+
+def format_order(order):
+    return (
+        f"{order['order_type']}?{order['price']}?{order['quantity']}?"
+        f"{order['price_denom']}?{order['asset_denom']}?LIMIT?{order['order_data']}"
+    )
+
 class LiquidityBot:
-    def __init__(self, key, password, contract, chain_id, binary) -> None:
+    def __init__(self, key, password, contract, chain_id, binary, rest_url, cache_ttl=2.0, tx_timeout=120.0) -> None:
         self.key = key
         self.password = password
         self.contract = contract
         self.binary = binary
         self.chain_id = chain_id
+        # queries go over one keep-alive connection instead of a seid process each
+        self._session = RestClient(rest_url)
+        # oracle rates only move once per vote period, denom -> (price, fetched_at)
+        self._price_cache = {}
+        self._price_ttl = cache_ttl
+        # (txhash, give_up_at) of broadcast txs whose block result hasn't been seen yet
+        self._pending_txs = deque()
+        self._tx_timeout = tx_timeout
+        self.address = self.get_key_address()
+        self._account_number, self._sequence = self.get_account()
+        # sequences are handed out locally so sync broadcasts can be pipelined
+        self._sequence_lock = asyncio.Lock()
+        # everything in the place-orders argv except the orders, deposit and
+        # sequence is fixed for the life of the bot, so build it once
+        self._place_orders_cmd = [binary, "tx", "dex", "place-orders", contract]
+        self._place_orders_flags = [
+            *PLACE_ORDERS_FLAGS,
+            f"--from={key}",
+            f"--chain-id={chain_id}",
+            f"--account-number={self._account_number}",
+        ]
+        self._password_input = (password + "\n").encode()
 
-    def generate_random_order(account_address):
-        ot = "Long"
-        scale = ((3*(random.uniform(0, 1)**3)+1)**2)/50
-        p = round(base_price * (1 + scale), 2)
-        l = 1
-        q = random.randint(quantity_floor, quantity_ceiling)
-
-        if random.getrandbits(1):
-            ot = "Short"
-            p = round(base_price * (1 - scale), 2)
-            l += 1
-
-        return PLACE_ORDER.format(contract=contract_address,
-                                account=account_address,
-                                order_type=ot,
-                                price=p,
-                                quantity=q,
-                                price_denom="SEI",
-                                asset_denom="ATOM",
-                                leverage=l,
-                                amount=round(p * q * 1000500)
-                                )
-
-    def get_oracle_price(self):
-        result = subprocess.check_output(
-            [
-                CMD.format(password=self.password, binary=self.binary) + 
-                EXCHANGE_RATES_TMPL.format(
-                    denom="uatom"
-                )
-            ],
-            stderr=subprocess.STDOUT,
-            shell=True,
+    def get_key_address(self):
+        result = subprocess.run(
+            [self.binary, "keys", "show", self.key, "-a"],
+            input=(self.password + "\n").encode(),
+            capture_output=True,
+            check=True,
         )
 
-        return float(result.decode('utf-8'))
+        return result.stdout.decode('utf-8').strip()
 
-    def place_order(self, order_type):
-        print("place_order")
-        od = OrderData()
-        data_json = json.dumps(OrderData().__dict__)
+    def get_account(self):
+        data = self._session.get_json(ACCOUNT_PATH.format(address=self.address))
+        account = data["account"]
 
-        # randomize order price and quantity
+        return int(account["account_number"]), int(account.get("sequence", 0))
+
+    def get_oracle_price(self, denom="uatom"):
+        cached = self._price_cache.get(denom)
+        if cached is not None and time.monotonic() - cached[1] < self._price_ttl:
+            return cached[0]
+
+        # one query returns every denom's rate, refresh them all at once
+        data = self._session.get_json(EXCHANGE_RATES_PATH)
+        fetched_at = time.monotonic()
+        # rebuild rather than update so a denom dropped by the oracle can't
+        # keep serving its last rate
+        self._price_cache = {
+            pair["denom"]: (float(pair["oracle_exchange_rate"]["exchange_rate"]), fetched_at)
+            for pair in data["denom_oracle_exchange_rate_pairs"]
+        }
+        if denom not in self._price_cache:
+            raise RuntimeError(f"no oracle exchange rate for {denom}")
+
+        return self._price_cache[denom][0]
+
+    def build_order(self, order_type, oracle_price, position_effect="Open", leverage="1"):
+        # randomize order price and quantity around the oracle price
         quantity = round(random.uniform(0, 1) * 10, 2)
-        print("quantity", quantity)
         if order_type == "SHORT":
-            price = self.get_oracle_price() + round(random.uniform(0, 1) * 5, 2)
+            price = oracle_price + round(random.uniform(0, 1) * 5, 2)
         else:
-            price = self.get_oracle_price() - round(random.uniform(0, 1) * 5, 2)
-
-        result = subprocess.check_output(
-            [
-                CMD.format(password=self.password, binary=self.binary) + 
-                PLACE_ORDER_TMPL.format(
-                    contract=self.contract,
-                    order_type=order_type,
-                    price=price,
-                    quantity=quantity,
-                    price_denom="USDC",
-                    asset_denom="ATOM",
-                    key=self.key, 
-                    chain_id=self.chain_id, 
-                    order_data=data_json
-                ) 
-            ],
-            stderr=subprocess.STDOUT,
-            shell=True,
+            price = oracle_price - round(random.uniform(0, 1) * 5, 2)
+
+        return {
+            "order_type": order_type,
+            "price": price,
+            "quantity": quantity,
+            "price_denom": "USDC",
+            "asset_denom": "ATOM",
+            "order_data": order_data_json(position_effect, leverage),
+        }
+
+    async def next_sequence(self):
+        async with self._sequence_lock:
+            sequence = self._sequence
+            self._sequence += 1
+            return sequence
+
+    async def resync_sequence(self, raw_log):
+        """Reset the local sequence after the node rejected one as stale."""
+        async with self._sequence_lock:
+            # CheckTx reports the sequence it expects, which already counts
+            # our txs still in the mempool; the REST account does not
+            match = EXPECTED_SEQUENCE_RE.search(raw_log)
+            if match:
+                self._sequence = int(match.group(1))
+            else:
+                _, self._sequence = await asyncio.to_thread(self.get_account)
+            print("resynced sequence", self._sequence)
+
+    async def flush_orders(self, orders):
+        """Place all `orders` in a single MsgPlaceOrders transaction."""
+        print("flush_orders", len(orders))
+
+        response = await self.broadcast_orders(orders, await self.next_sequence())
+        if (
+            response.get("codespace") == SEQUENCE_MISMATCH_CODESPACE
+            and response["code"] == SEQUENCE_MISMATCH_CODE
+        ):
+            await self.resync_sequence(response["raw_log"])
+            response = await self.broadcast_orders(orders, await self.next_sequence())
+
+        # sync mode only runs CheckTx, the block result is harvested by poll_txs
+        if response["code"]:
+            # a rejected batch is skipped like a failed tx, the next cycle
+            # resyncs the unused sequence through ErrWrongSequence
+            print("tx rejected", response["raw_log"])
+            return
+        print("broadcast", response["txhash"])
+        self._pending_txs.append((response["txhash"], time.monotonic() + self._tx_timeout))
+
+    async def broadcast_orders(self, orders, sequence):
+        cmd = [
+            *self._place_orders_cmd,
+            *map(format_order, orders),
+            *self._place_orders_flags,
+            f"--amount={ORDER_DEPOSIT_UUSDC * len(orders)}uusdc",
+            f"--sequence={sequence}",
+        ]
+        # exec seid directly and answer the keyring prompt on stdin, no shell
+        proc = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
         )
-        print(result)
+        result, err = await proc.communicate(self._password_input)
+        if proc.returncode:
+            raise subprocess.CalledProcessError(proc.returncode, cmd, output=result, stderr=err)
+
+        return json.loads(result)
+
+    async def poll_txs(self, interval=1.0):
+        """Log the block result of every broadcast tx once it is committed."""
+        while True:
+            for _ in range(len(self._pending_txs)):
+                txhash, give_up_at = self._pending_txs.popleft()
+                try:
+                    data = await asyncio.to_thread(
+                        self._session.get_json, TX_PATH.format(txhash=txhash), True
+                    )
+                    if data is not None:
+                        code = data["tx_response"]["code"]
+                        raw_log = data["tx_response"]["raw_log"]
+                except Exception as e:
+                    # a flaky node must not stop the poller, retry the hash next round
+                    print("tx poll error", txhash, repr(e))
+                    data = None
+                if data is None:
+                    if time.monotonic() < give_up_at:
+                        self._pending_txs.append((txhash, give_up_at))
+                    else:
+                        # never committed, most likely dropped from the mempool
+                        print("tx not found, giving up", txhash)
+                elif code:
+                    print("tx failed", txhash, raw_log)
+                else:
+                    print("tx committed", txhash)
+            await asyncio.sleep(interval)
 
 
 if __name__ == "__main__":
@@ -112,11 +251,39 @@ if __name__ == "__main__":
     parser.add_argument('contract', help='Contract address', type=str)
     parser.add_argument('chain_id', help='Chain id', type=str, default='sei-chain')
     parser.add_argument('--binary', help='Your seid binary path', type=str, default=str(Path.home()) + '/go/bin/seid')
+    parser.add_argument('--rest', help='Node REST (LCD) endpoint', type=str, default='http://localhost:1317')
+    parser.add_argument('--price-ttl', help='Seconds to reuse a fetched oracle price', type=float, default=2.0)
+    parser.add_argument('--orders-per-side', help='LONG and SHORT orders batched into each transaction', type=int, default=1)
+    parser.add_argument('--tx-timeout', help='Seconds to wait for a broadcast tx to be committed', type=float, default=120.0)
+    parser.add_argument('--min-interval', help='Min seconds between the start of two submission cycles', type=float, default=30.0)
     args=parser.parse_args()
 
-    lb = LiquidityBot(args.key, args.password, args.contract, args.chain_id, args.binary)
-    
-    while True:
-        lb.place_order("LONG")
-        lb.place_order("SHORT")
-        time.sleep(30)
+    lb = LiquidityBot(
+        args.key, args.password, args.contract, args.chain_id, args.binary, args.rest,
+        args.price_ttl, args.tx_timeout,
+    )
+
+    def log_poller_exit(task):
+        if not task.cancelled() and task.exception() is not None:
+            print("tx poller stopped", repr(task.exception()))
+
+    async def main():
+        poller = asyncio.create_task(lb.poll_txs())
+        poller.add_done_callback(log_poller_exit)
+        try:
+            while True:
+                next_allowed = time.monotonic() + args.min_interval
+                # one price per cycle, every order in the batch quotes around it
+                oracle_price = await asyncio.to_thread(lb.get_oracle_price)
+                orders = [
+                    lb.build_order(order_type, oracle_price)
+                    for order_type in ["LONG", "SHORT"] * args.orders_per_side
+                ]
+                await lb.flush_orders(orders)
+                # pace cycles by start time so slow submissions don't add to the gap
+                await asyncio.sleep(max(0, next_allowed - time.monotonic()))
+        finally:
+            poller.cancel()
+            await asyncio.gather(poller, return_exceptions=True)
+
+    asyncio.run(main())